@@ -5,11 +5,21 @@
 # - Muestra métricas por región y permite descargar CSV.
 # ---------------------------------------------------------
 
+import io
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import streamlit as st
-from skimage import data, filters, morphology, measure, color
+from PIL import Image
+from scipy import ndimage as ndi
+from skimage import data, filters
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from kernels import block_medians, label_stats, overlay_u8
 
 # 1) Configuración general de la página
 st.set_page_config(
@@ -22,112 +32,231 @@ st.set_page_config(
 st.title("🪙 Segmentación simple con skimage + Streamlit")
 st.write("Esta app binariza la imagen de monedas, limpia la máscara, etiqueta regiones y calcula métricas.")
 
-# 3) Barra lateral: parámetros de usuario (widgets)
+# 3) Barra lateral: parámetros de usuario (los sliders se crean dentro del
+#    fragmento del paso 6)
 st.sidebar.header("Parámetros")
-min_obj = st.sidebar.slider("Tamaño mínimo de objetos (px)", 0, 1000, 50, 10)
-min_hole = st.sidebar.slider("Tamaño mínimo de agujeros (px)", 0, 1000, 50, 10)
 
 # Botón opcional para limpiar caché (demostración)
-# Nota: si aún no se definió compute_pipeline en esta ejecución, lo indicamos.
+# Vacía todas las etapas cacheadas con st.cache_data de una sola vez.
 if st.sidebar.button("🧹 Limpiar caché de datos"):
-    try:
-        compute_pipeline.clear()
-        st.sidebar.success("Caché limpiada.")
-    except NameError:
-        st.sidebar.info("La función cacheada aún no se definió en esta sesión.")
-
-# 4) Carga de la imagen (coins)
-img = data.coins()  # 2D uint8 (H, W), escala de grises
+    st.cache_data.clear()
+    st.sidebar.success("Caché limpiada.")
+
+# 4) Carga de la imagen (coins), cacheada: no depende de los sliders
+@st.cache_data(show_spinner=False)
+def load_image():
+    return data.coins()  # 2D uint8 (H, W), escala de grises
+
+img = load_image()
 H, W = img.shape
 
-# 5) Pipeline de procesamiento cacheado (st.cache_data)
+# 5) Pipeline de procesamiento por etapas cacheadas (st.cache_data)
+#    Cada etapa solo se recalcula cuando cambian sus propias entradas:
+#    mover un slider invalida la limpieza/etiquetado, no el umbral de Otsu.
+#    Las etapas reciben solo los parámetros enteros y obtienen la imagen de
+#    load_image(): así Streamlit no tiene que hashear arrays en cada rerun.
+#    Lo que devuelven se guarda compacto (máscaras empaquetadas a 1 bit por
+#    píxel, etiquetas en el entero más pequeño posible, imágenes ya
+#    codificadas en PNG) porque st.cache_data serializa cada resultado.
+
+def pack_mask(mask: np.ndarray):
+    return np.packbits(mask), mask.shape
+
+def unpack_mask(packed):
+    bits, shape = packed
+    return np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape).view(bool)
+
+def to_png(arr: np.ndarray):
+    # st.image recodifica los arrays en cada rerun; los bytes PNG ya
+    # codificados (y cacheados) se sirven tal cual si se muestran con
+    # output_format="PNG" (con "auto" Streamlit los recodificaría a JPEG).
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
 @st.cache_data(show_spinner=False)
-def compute_pipeline(img: np.ndarray, min_obj: int, min_hole: int):
-    # 5.1) Umbral de Otsu
+def original_png():
+    return to_png(load_image())
+
+# 5.1) Umbral de Otsu (independiente de los sliders)
+@st.cache_data(show_spinner=False)
+def otsu_mask():
+    img = load_image()
     threshold = filters.threshold_otsu(img)
     mask = img > threshold  # bool
+    return float(threshold), pack_mask(mask)
+
+# 5.2) Limpieza morfológica y etiquetado (OpenCV)
+def drop_small_components(mask: np.ndarray, min_size: int):
+    # Equivale a morphology.remove_small_objects (conectividad 1):
+    # connectedComponentsWithStats etiqueta y devuelve el área de cada
+    # componente en una sola llamada; el filtro es una tabla booleana
+    # indexada por etiqueta, sin bucles en Python.
+    _, lbl, stats, _ = cv2.connectedComponentsWithStats(mask.view(np.uint8), connectivity=4)
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_size
+    keep[0] = False  # el fondo nunca se conserva
+    return keep[lbl]
+
+@st.cache_data(show_spinner=False)
+def clean_and_label(min_obj: int, min_hole: int):
+    _, mask_packed = otsu_mask()
+    mask = unpack_mask(mask_packed)
+
+    # Limpieza condicional para permitir 0; los agujeros son componentes
+    # pequeñas del fondo, así que se eliminan sobre la máscara invertida.
+    mask_clean = drop_small_components(mask, min_obj) if min_obj > 0 else mask
+    mask_clean = ~drop_small_components(~mask_clean, min_hole) if min_hole > 0 else mask_clean
+
+    # Etiquetado con conectividad 1 (4 vecinos), la misma que usa la limpieza.
+    # OpenCV cuenta el fondo como una etiqueta más, de ahí el - 1.
+    n, label_img = cv2.connectedComponents(mask_clean.view(np.uint8), connectivity=4)
+    n_labels = n - 1
+    label_img = label_img.astype(np.min_scalar_type(n_labels), copy=False)
+    return to_png(mask_clean), label_img, n_labels
 
-    # 5.2) Limpieza morfológica (condicional para permitir 0)
-    mask_clean = morphology.remove_small_objects(mask, min_size=min_obj) if min_obj > 0 else mask
-    mask_clean = morphology.remove_small_holes(mask_clean, area_threshold=min_hole) if min_hole > 0 else mask_clean
-
-    # 5.3) Etiquetado (conectividad por defecto de skimage)
-    label_img = measure.label(mask_clean)
-
-    # 5.4) Propiedades por región
-    props = measure.regionprops(label_img, intensity_image=img)
-    rows = []
-    for r in props:
-        intensities = r.intensity_image[r.image]
-        median_val = float(np.median(intensities)) if intensities.size > 0 else float("nan")
-        rows.append({
-            "label": int(r.label),
-            "area": int(r.area),
-            "bbox_r0": int(r.bbox[0]),
-            "bbox_c0": int(r.bbox[1]),
-            "bbox_r1": int(r.bbox[2]),
-            "bbox_c1": int(r.bbox[3]),
-            "mean": float(r.mean_intensity),
-            "median": median_val,
-            "min": float(r.min_intensity),
-            "max": float(r.max_intensity),
-        })
-    df = pd.DataFrame(rows).sort_values("label").reset_index(drop=True)
-
-    # 5.5) Overlay de etiquetas sobre la imagen original
-    overlay = color.label2rgb(label_img, image=img, bg_label=0, alpha=0.3)
-    overlay_uint8 = (overlay * 255).astype(np.uint8)
+# 5.3) Propiedades por región (una sola pasada vectorizada sobre label_img)
+def region_medians(img: np.ndarray, label_img: np.ndarray, area: np.ndarray):
+    # Un argsort estable por etiqueta (radix sort para enteros pequeños) deja
+    # los píxeles de primer plano de cada región en un bloque contiguo; los
+    # tamaños de bloque son la columna `area`.
+    lbl = label_img.ravel()
+    fg = lbl > 0
+    lbl_fg = lbl[fg]
+    values = img.ravel()[fg][np.argsort(lbl_fg, kind="stable")]
+    return block_medians(values, area)
+
+@st.cache_data(show_spinner=False)
+def region_table(min_obj: int, min_hole: int):
+    img = load_image()
+    _, label_img, n = clean_and_label(min_obj, min_hole)
+    idx = np.arange(1, n + 1)
+    s, mn, mx, cnt = label_stats(img.ravel(), label_img.ravel(), n + 1)
+    area = cnt[1:]
+    # Cajas envolventes en un único array (n, 4) -> filas contiguas r0, c0, r1, c1
+    bbox = np.array(
+        [(sl[0].start, sl[1].start, sl[0].stop, sl[1].stop) for sl in ndi.find_objects(label_img)],
+        dtype=np.int32,
+    ).reshape(-1, 4)
+    r0, c0, r1, c1 = np.ascontiguousarray(bbox.T)
+    # Tabla Arrow: es el formato que Streamlit envía al navegador, así que
+    # st.dataframe no necesita convertir desde NumPy en cada rerun.
+    tbl = pa.table({
+        "label": pa.array(idx, pa.int32()),
+        "area": pa.array(area, pa.int32()),
+        "bbox_r0": pa.array(r0, pa.int32()),
+        "bbox_c0": pa.array(c0, pa.int32()),
+        "bbox_r1": pa.array(r1, pa.int32()),
+        "bbox_c1": pa.array(c1, pa.int32()),
+        "mean": pa.array(s[1:] / area, pa.float32()),
+        "median": pa.array(region_medians(img, label_img, area), pa.float32()),
+        "min": pa.array(mn[1:], pa.float32()),
+        "max": pa.array(mx[1:], pa.float32()),
+    })
+
+    # CSV para la descarga, generado una vez por combinación de parámetros
+    # con el escritor columnar de Arrow (mucho más rápido que DataFrame.to_csv)
+    buf = pa.BufferOutputStream()
+    pa_csv.write_csv(tbl, buf)
+    return tbl, buf.getvalue().to_pybytes()
+
+# 5.4) Overlay de etiquetas sobre la imagen original
+@st.cache_data(show_spinner=False)
+def overlay_image(min_obj: int, min_hole: int):
+    img = load_image()
+    _, label_img, n_labels = clean_and_label(min_obj, min_hole)
+    # Tabla de colores por etiqueta (semilla fija: colores estables entre reruns)
+    rng = np.random.default_rng(0)
+    colors_u8 = rng.integers(0, 256, size=(n_labels + 1, 3), dtype=np.uint8)
+    overlay = np.empty(img.size * 3, dtype=np.uint8)
+    overlay_u8(img.ravel(), label_img.ravel(), colors_u8, 3, 10, overlay)  # alpha = 0.3
+    return to_png(overlay.reshape(img.shape + (3,)))
+
+# 5.5) Orquestación: une las etapas cacheadas
+def compute_pipeline(min_obj: int, min_hole: int):
+    threshold, _ = otsu_mask()
+    mask_png, _, n_labels = clean_and_label(min_obj, min_hole)
+
+    # Tabla y overlay solo dependen de label_img e img: en la primera ejecución
+    # se calculan (y se guardan en caché) en paralelo. Los hilos heredan el
+    # contexto de Streamlit para que st.cache_data funcione sin avisos.
+    # El pool solo compensa con la caché fría: con la caché caliente ambas
+    # tareas son simples lecturas de caché y crear los hilos es coste extra.
+    # add_script_run_ctx/get_script_run_ctx son API interna de Streamlit
+    # (streamlit.runtime.scriptrunner) y pueden cambiar entre versiones.
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=2,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as ex:
+        fut_tbl = ex.submit(region_table, min_obj, min_hole)
+        fut_overlay = ex.submit(overlay_image, min_obj, min_hole)
+        tbl, csv_bytes = fut_tbl.result()
+        overlay_png = fut_overlay.result()
 
     return {
-        "threshold": float(threshold),
-        "mask": mask,
-        "mask_clean": mask_clean,
-        "label_img": label_img,
-        "df": df,
-        "overlay": overlay_uint8,
+        "threshold": threshold,
+        "img_png": original_png(),
+        "mask_png": mask_png,
+        "n_labels": n_labels,
+        "table": tbl,
+        "csv": csv_bytes,
+        "overlay_png": overlay_png,
     }
 
-# 6) Ejecutar pipeline (con spinner y medición de tiempo)
-with st.spinner("Procesando..."):
-    t0 = time.time()
-    out = compute_pipeline(img, min_obj, min_hole)
-    dt = time.time() - t0
-
-# 7) Métricas rápidas y visualizaciones
-c_top1, c_top2, c_top3 = st.columns(3)
-with c_top1:
-    st.metric("Umbral Otsu", f"{out['threshold']:.1f}")
-with c_top2:
-    st.metric("Regiones detectadas", int(out["label_img"].max()))
-with c_top3:
-    st.metric("Tiempo (s)", f"{dt:.3f}")
-
-# Tres columnas con imágenes clave
-col1, col2, col3 = st.columns(3)
-with col1:
-    st.image(img, caption=f"Original ({W}x{H})", use_column_width=True, clamp=True)
-with col2:
-    st.image(out["mask_clean"], caption="Máscara limpia", use_column_width=True)
-with col3:
-    st.image(out["overlay"], caption="Etiquetas sobrepuestas", use_column_width=True)
-
-# 8) Tabla de características y descarga
-st.subheader("Características por región")
-df_display = out["df"].copy()
-for col in ["mean", "median", "min", "max"]:
-    if col in df_display.columns:
-        df_display[col] = df_display[col].round(2)
-st.dataframe(df_display, use_container_width=True)
-
-csv_bytes = out["df"].to_csv(index=False).encode("utf-8")
-st.download_button("⬇️ Descargar tabla (CSV)", data=csv_bytes, file_name="region_props.csv", mime="text/csv")
+# 6) Bloque interactivo como fragmento (st.fragment): al mover un slider solo
+#    se vuelve a ejecutar esta función, no el script completo. Los sliders
+#    siguen en la barra lateral: desde streamlit 1.59 un fragmento puede
+#    escribir directamente en st.sidebar.
+@st.fragment
+def pipeline_block():
+    # 6.1) Parámetros de usuario (widgets en la barra lateral)
+    min_obj = st.sidebar.slider("Tamaño mínimo de objetos (px)", 0, 1000, 50, 10)
+    min_hole = st.sidebar.slider("Tamaño mínimo de agujeros (px)", 0, 1000, 50, 10)
+
+    # 6.2) Ejecutar pipeline (con spinner y medición de tiempo)
+    with st.spinner("Procesando..."):
+        t0 = time.time()
+        out = compute_pipeline(min_obj, min_hole)
+        dt = time.time() - t0
+
+    # 7) Métricas rápidas y visualizaciones
+    c_top1, c_top2, c_top3 = st.columns(3)
+    with c_top1:
+        st.metric("Umbral Otsu", f"{out['threshold']:.1f}")
+    with c_top2:
+        st.metric("Regiones detectadas", out["n_labels"])
+    with c_top3:
+        st.metric("Tiempo (s)", f"{dt:.3f}")
+
+    # Tres columnas con imágenes clave
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.image(out["img_png"], caption=f"Original ({W}x{H})", use_column_width=True, output_format="PNG")
+    with col2:
+        st.image(out["mask_png"], caption="Máscara limpia", use_column_width=True, output_format="PNG")
+    with col3:
+        st.image(out["overlay_png"], caption="Etiquetas sobrepuestas", use_column_width=True, output_format="PNG")
+
+    # 8) Tabla de características y descarga
+    st.subheader("Características por región")
+    # Formato de 2 decimales solo en la vista: column_config lo aplica el navegador,
+    # así que la tabla Arrow cacheada se envía tal cual, sin pasar por pandas
+    st.dataframe(
+        out["table"],
+        column_config={col: st.column_config.NumberColumn(format="%.2f") for col in ["mean", "median", "min", "max"]},
+        use_container_width=True,
+    )
+
+    st.download_button("⬇️ Descargar tabla (CSV)", data=out["csv"], file_name="region_props.csv", mime="text/csv")
+
+pipeline_block()
 
 # 9) Explicación breve (útil para clase; se puede ocultar en un expander)
 with st.expander("¿Qué está pasando aquí?"):
     st.markdown(
-        "- Streamlit ejecuta este script de arriba a abajo cada vez que cambias un slider o haces clic.\n"
-        "- Los sliders en la barra lateral controlan parámetros del procesamiento.\n"
-        "- st.cache_data guarda el resultado de compute_pipeline para evitar recomputar si no cambian los parámetros.\n"
+        "- Streamlit ejecuta este script de arriba a abajo cada vez que haces clic en un widget.\n"
+        "- Los sliders en la barra lateral controlan parámetros del procesamiento; se crean dentro de un st.fragment, así que al moverlos solo se vuelve a ejecutar ese bloque.\n"
+        "- st.cache_data guarda el resultado de cada etapa del pipeline; solo se recalculan las etapas cuyos parámetros cambian.\n"
         "- Mostramos imágenes y una tabla con st.image y st.dataframe.\n"
         "- st.download_button permite exportar resultados (CSV).\n"
     )
@@ -0,0 +1,67 @@
+# kernels.py
+# ---------------------------------------------------------
+# Kernels compilados con Numba que usa app.py.
+# - Viven en un módulo sin efectos secundarios: Numba guarda en su caché
+#   (cache=True) el nombre del módulo y lo reimporta al cargarla; si fuese
+#   app.py, reimportarlo volvería a ejecutar toda la página de Streamlit.
+# - Son secuenciales a propósito: Streamlit ejecuta el script fuera del hilo
+#   principal y los kernels parallel=True de Numba no son seguros ahí.
+# ---------------------------------------------------------
+
+import numpy as np
+from numba import njit
+
+@njit(cache=True, nogil=True)
+def label_stats(img_flat, lbl_flat, n):
+    # Kernel compilado: suma, mínimo, máximo y conteo por etiqueta en una sola
+    # lectura lineal de img/label_img (el recorrido está limitado por memoria).
+    s = np.zeros(n)
+    mn = np.full(n, np.inf)
+    mx = np.full(n, -np.inf)
+    cnt = np.zeros(n, dtype=np.int64)
+    for i in range(img_flat.size):
+        l = lbl_flat[i]
+        v = float(img_flat[i])
+        s[l] += v
+        cnt[l] += 1
+        if v < mn[l]:
+            mn[l] = v
+        if v > mx[l]:
+            mx[l] = v
+    return s, mn, mx, cnt
+
+@njit(cache=True, nogil=True)
+def block_medians(values, area):
+    # Mediana de cada bloque contiguo de `values` (uno por etiqueta) con
+    # np.partition, O(k) por región en lugar del O(k log k) de ordenar.
+    out = np.empty(area.size)
+    start = 0
+    for i in range(area.size):
+        k = area[i]
+        block = np.partition(values[start:start + k], k // 2)
+        hi = float(block[k // 2])
+        # Con k par, el otro valor central es el máximo de la mitad inferior
+        out[i] = (block[:k // 2].max() + hi) / 2.0 if k % 2 == 0 else hi
+        start += k
+    return out
+
+@njit(cache=True, nogil=True)
+def overlay_u8(img_flat, lbl_flat, colors_u8, alpha_num, alpha_den, out):
+    # Kernel fusionado para el overlay: lee img y label_img una vez y escribe
+    # el RGB uint8 directamente en `out` (H*W*3), con aritmética entera y
+    # redondeo, sin buffers float intermedios. No equivale a color.label2rgb:
+    # el fondo (0) conserva el gris original en vez de oscurecerse a
+    # (1 - alpha) * gris, los colores son aleatorios (no el ciclo de colores de
+    # skimage) y el redondeo es entero.
+    half = alpha_den // 2
+    for i in range(img_flat.size):
+        l = lbl_flat[i]
+        g = np.int64(img_flat[i])
+        if l == 0:
+            out[3 * i] = g
+            out[3 * i + 1] = g
+            out[3 * i + 2] = g
+        else:
+            for ch in range(3):
+                c = np.int64(colors_u8[l, ch])
+                out[3 * i + ch] = (alpha_num * c + (alpha_den - alpha_num) * g + half) // alpha_den